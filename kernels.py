@@ -0,0 +1,30 @@
+import math
+
+import numpy as np
+from numba import njit
+
+
+# Lives outside pytides-sites.py because streamlit re-executes the script into a
+# fresh module on every rerun, which would recompile the kernel each time. As an
+# imported module it is compiled once per process (and cached on disk).
+# parallel=True is deliberately not used: every streamlit session runs in its own
+# thread and numba's default workqueue threading layer aborts on concurrent
+# parallel launches.
+@njit(fastmath=True, cache=True)
+def reconstruct_numba(
+    t: np.ndarray,
+    block: np.ndarray,
+    omega: np.ndarray,
+    A: np.ndarray,
+    phi: np.ndarray,
+    u: np.ndarray,
+    f: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    """Accumulate the harmonic sum into ``out`` without a (K, N) temporary."""
+    for i in range(t.size):
+        b = block[i]
+        s = 0.0
+        for k in range(A.size):
+            s += A[k] * f[k, b] * math.cos(omega[k] * t[i] + phi[k] + u[k, b])
+        out[i] = s
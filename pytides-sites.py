@@ -1,12 +1,19 @@
 import base64
-from typing import Any, Dict, List, Tuple
+import io
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
-import matplotlib.dates as mdates
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
 import streamlit as st
-import utide
+from pytides2 import constituent
 from pytides2.tide import Tide
+from streamlit.uploaded_file_manager import UploadedFile
+
+from kernels import reconstruct_numba
 
 st.set_page_config(layout="wide")
 st.title("🌊 Pytides Online")
@@ -17,6 +24,7 @@ st.markdown(
 This website can calculate harmonic constituent using:
 - [pytides2](https://github.com/sahitono/pytides). The calculation is based on [P. Schureman in Special Publication 98](https://tidesandcurrents.noaa.gov/publications/SpecialPubNo98.pdf). The original pytides is written by [Sam Cox](https://github.com/sam-cox/pytides).
 - [utide](https://github.com/wesleybowman/UTide). Originally made by [Codiga, D.L](http://www.po.gso.uri.edu/~codiga/utide/utide.htm) in matlab.
+- fft. Same fit as pytides, but starts the solver from an FFT estimate of the record. The data must be regularly sampled.
 
 Notes:
 - The data should be something like this:
@@ -36,12 +44,14 @@ Have a nice day, stay healthy & dont forget to wear your mask 😄
 """,
     unsafe_allow_html=True,
 )
-uploaded_file: str = st.file_uploader("Choose your .csv file", type=["csv", "txt"])
+uploaded_file: Optional[UploadedFile] = st.file_uploader(
+    "Choose your .csv file", type=["csv", "txt"]
+)
 
 
 with st.sidebar:
     tide_backend: str = st.sidebar.selectbox(
-        "Choose tides calculation method", ("utide", "pytides")
+        "Choose tides calculation method", ("utide", "pytides", "fft")
     )
     show_data: bool = st.checkbox("show datasource table")
     if tide_backend == "utide":
@@ -57,59 +67,287 @@ with st.sidebar:
         method: str = st.sidebar.selectbox("Choose method", ("ols", "robust"))
 
 
+SERIES_TYPES: List[str] = ["source", "prediction"]
+
+
+def series_type(n: int, name: str) -> pd.Categorical:
+    """Constant ``type`` column sharing one category set so concat stays cheap."""
+    codes = np.full(n, SERIES_TYPES.index(name), dtype=np.int8)
+    return pd.Categorical.from_codes(codes, categories=SERIES_TYPES)
+
+
 @st.cache
 def load_file() -> pd.DataFrame:
-    tide_data: "pd.DataFrame" = pd.read_csv(
-        uploaded_file,
-    )
+    tide_data: "pd.DataFrame" = pd.read_csv(uploaded_file)
 
-    if tuple(tide_data.columns) != ("datetime", "water level"):
+    if set(tide_data.columns) != {"datetime", "water level"}:
         raise ValueError(
             f"""
         Column name should be 'datetime' and 'water level'.\b
         Your column is f{tuple(tide_data.columns)}"""
         )
 
-    tide_data["datetime"] = pd.to_datetime(tide_data["datetime"], yearfirst=True)
-    # tide_data["datetime"] = pd.to_datetime(tide_data["datetime"], dayfirst=True)
-    tide_data["type"] = ["source"] * len(tide_data.index)
+    tide_data["water level"] = tide_data["water level"].astype("float32")
+    tide_data["datetime"] = pd.to_datetime(tide_data["datetime"], utc=True, cache=True)
+    tide_data["type"] = series_type(len(tide_data.index), "source")
     tide_data.sort_values(by="datetime", inplace=True)
 
     return tide_data
 
 
-def solve_pytides(data: pd.DataFrame) -> Tuple["Tide", pd.DataFrame]:
+def _series_key(data: pd.DataFrame) -> Tuple[int, int]:
+    """Hash only the raw series buffers so st.cache skips walking the frame."""
+    return (
+        hash(data["datetime"].values.tobytes()),
+        hash(data["water level"].values.tobytes()),
+    )
+
+
+@st.cache(allow_output_mutation=True, hash_funcs={pd.DataFrame: _series_key})
+def solve_pytides(data: pd.DataFrame) -> Tuple["Tide", pd.DataFrame, np.ndarray]:
     tide = Tide.decompose(data["water level"], data["datetime"])
     if not isinstance(tide, Tide):
         raise ValueError(f"{tide} is not a valid tide.")
 
-    constituents: List[str] = [c.name for c in tide.model["constituent"]]
+    constituents: np.ndarray = np.array(
+        [c.name for c in tide.model["constituent"]], dtype=object
+    )
     tide_harmonic = pd.DataFrame(tide.model, index=constituents).drop(
         "constituent", axis=1
     )
 
-    return tide, tide_harmonic
+    return tide, tide_harmonic, constituents
+
+
+# Candidates for _fft_guess, with the Z0 and same-speed filtering that
+# Tide.decompose does internally.
+_FFT_CANDIDATES: List["constituent.BaseConstituent"] = [
+    c for c in OrderedDict.fromkeys(constituent.noaa) if not c == constituent._Z0
+]
+
+
+def _fft_guess(data: pd.DataFrame) -> "Tide":
+    """Estimate each NOAA constituent from its nearest FFT bin.
+
+    Requires a regularly sampled record without gaps. Amplitudes and phases
+    are corrected with the node factors at the middle of the record. This is
+    only a first guess: constituents sharing a bin are left out.
+    """
+    times = pd.DatetimeIndex(data["datetime"])
+    hours = np.asarray((times - times[0]) / pd.Timedelta(hours=1))
+    heights = data["water level"].to_numpy(dtype=np.float64)
+    n = heights.size
+
+    gaps = np.diff(hours) if n > 1 else np.zeros(1)
+    step = float(np.median(gaps))
+    if step <= 0 or not np.allclose(gaps, step):
+        raise ValueError(
+            f"""
+        The fft method needs a regularly sampled record without gaps.\b
+        Your intervals range from {gaps.min()} to {gaps.max()} hours,
+        try pytides or utide instead."""
+        )
+    if np.isnan(heights).any():
+        raise ValueError(
+            f"""
+        The fft method cannot handle missing water levels.\b
+        Your data has {int(np.isnan(heights).sum())} empty rows."""
+        )
+
+    z0 = heights.mean()
+    spectrum = np.fft.rfft(heights - z0)
+
+    # Tide.prepare is the public way to get speeds, node factors and
+    # equilibrium arguments, so evaluate it on a unit model of the candidates.
+    t0 = times[0].to_pydatetime()
+    candidates = _FFT_CANDIDATES
+    unit = Tide(
+        constituents=candidates,
+        amplitudes=[1.0] * len(candidates),
+        phases=[0.0] * len(candidates),
+    )
+    speed, u, f, V0 = unit.prepare(
+        t0, [t0 + timedelta(hours=hours[-1] / 2)], radians=True
+    )
+    exact = speed[:, 0] * n * step / (2 * np.pi)
+    k = np.rint(exact).astype(np.intp)
+
+    # Only keep constituents with at least two cycles in the record, and one
+    # constituent per bin since the FFT cannot resolve them apart.
+    _, first = np.unique(k, return_index=True)
+    keep = np.sort(first[(k[first] >= 2) & (k[first] < spectrum.size)])
+    H = spectrum[k[keep]]
+
+    # Undo the gain and phase shift of reading a line that sits delta bins
+    # away from the bin centre.
+    delta = exact[keep] - k[keep]
+    amplitudes = 2 * np.abs(H) / (n * np.sinc(delta)) / f[0][keep, 0]
+    angle = np.angle(H) - np.pi * delta * (n - 1) / n
+    phases = (V0 + u[0])[keep, 0] - angle
+    # pytides2 only exposes the mean level constituent as the private _Z0;
+    # Tide.decompose itself uses it the same way.
+    return Tide(
+        constituents=[constituent._Z0] + [candidates[i] for i in keep],
+        amplitudes=[z0] + list(amplitudes),
+        phases=[0.0] + list(phases),
+        radians=True,
+    )
+
 
+@st.cache(allow_output_mutation=True, hash_funcs={pd.DataFrame: _series_key})
+def solve_fft(data: pd.DataFrame) -> Tuple["Tide", pd.DataFrame, np.ndarray]:
+    """Least squares fit like ``solve_pytides``, seeded with ``_fft_guess``.
 
+    The fit still covers every NOAA constituent; the FFT estimate only gives
+    the solver a starting point close to the answer.
+    """
+    tide = Tide.decompose(
+        data["water level"], data["datetime"], initial=_fft_guess(data)
+    )
+    if not isinstance(tide, Tide):
+        raise ValueError(f"{tide} is not a valid tide.")
+
+    constituents: np.ndarray = np.array(
+        [c.name for c in tide.model["constituent"]], dtype=object
+    )
+    tide_harmonic = pd.DataFrame(tide.model, index=constituents).drop(
+        "constituent", axis=1
+    )
+
+    return tide, tide_harmonic, constituents
+
+
+def prediction_range(start_date: Any, end_date: Any, interval: int) -> pd.DatetimeIndex:
+    """Build the inclusive UTC prediction grid directly from int64 nanoseconds."""
+    start_ns = np.datetime64(start_date, "ns").astype("i8")
+    end_ns = np.datetime64(end_date, "ns").astype("i8")
+    arr = np.arange(start_ns, end_ns + 1, interval * 10 ** 9, dtype="i8")
+    return pd.DatetimeIndex(arr.view("datetime64[ns]"), tz="UTC")
+
+
+def predict_pytides(tide: "Tide", datetime_arr: pd.DatetimeIndex) -> np.ndarray:
+    """Vectorized equivalent of ``tide.at(datetime_arr)``.
+
+    Node factors are held constant over the same 240 hour partitions pytides2
+    uses, but the hour offsets and partition lookup are done in numpy and the
+    harmonic sum in ``reconstruct_numba`` instead of per-timestamp Python loops.
+    """
+    if datetime_arr.size == 0:
+        return np.empty(0, dtype=np.float32)
+
+    partition = 240.0
+    hours = np.asarray((datetime_arr - datetime_arr[0]) / pd.Timedelta(hours=1))
+    block = np.floor(hours / partition).astype(np.intp)
+
+    t0 = datetime_arr[0].to_pydatetime()
+    times = [t0 + timedelta(hours=(i + 0.5) * partition) for i in range(block[-1] + 1)]
+    speed, u, f, V0 = tide.prepare(t0, times, radians=True)
+
+    # Gauge heights don't need float64, but the phase argument grows to ~1e5
+    # radians over long windows, so speed, phi and u stay float64.
+    amplitude = tide.model["amplitude"].astype(np.float32)
+    phi = (V0 - np.deg2rad(tide.model["phase"])[:, None]).ravel()
+    f = np.hstack(f).astype(np.float32)
+
+    out = np.empty(hours.size, dtype=np.float32)
+    reconstruct_numba(hours, block, speed.ravel(), amplitude, phi, np.hstack(u), f, out)
+    return out
+
+
+# Proleptic Gregorian ordinal of 1970-01-01, the "python" epoch utide expects.
+_ORDINAL_EPOCH: int = 719163
+
+
+def to_utide_days(values: np.ndarray) -> np.ndarray:
+    """Convert datetime64 values to utide's days since 0001-01-01 (day 1)."""
+    ns = np.asarray(values, dtype="datetime64[ns]").view("i8")
+    return ns / 86400e9 + _ORDINAL_EPOCH
+
+
+@st.cache(allow_output_mutation=True, hash_funcs={pd.DataFrame: _series_key})
 def solve_utide(data: pd.DataFrame) -> Tuple[Dict[str, Any], Dict[str, Any]]:
-    time = mdates.date2num(data.datetime)
+    # utide is only imported once a session picks it, to keep cold start fast
+    import utide
+
+    time = to_utide_days(data.datetime.values)
     coef = utide.solve(
-        time, data["water level"].to_numpy(), lat=-25, method="ols", conf_int="MC"
+        time,
+        np.asarray(data["water level"], dtype=np.float64),
+        lat=-25,
+        method="ols",
+        conf_int="MC",
     )
     tide = utide.reconstruct(time, coef)
     return tide, coef
 
 
-def main_utide(tide_data: pd.DataFrame) -> None:
-    tide, coef = solve_utide(tide_data)
-    tide_harmonic = pd.DataFrame(
-        {
-            "name": ["mean"] + list(coef["name"]),
-            "amplitude": [coef["mean"]] + list(coef["A"]),
-            "phase": [0] + list(coef["g"]),
-        }
+def lttb_downsample(x: np.ndarray, y: np.ndarray, n_out: int = 2000) -> np.ndarray:
+    """Return indices of the Largest-Triangle-Three-Buckets subset of (x, y)."""
+    n = x.size
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.intp)
+    idx = np.empty(n_out, dtype=np.intp)
+    idx[0], idx[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < edges.size else n
+        cx, cy = x[hi:next_hi].mean(), y[hi:next_hi].mean()
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx
+
+
+def decimate(tide_data: pd.DataFrame, n_out: int = 2000) -> pd.DataFrame:
+    """Reduce each ``type`` series to at most ``n_out`` points for plotting."""
+    groups = []
+    for _, group in tide_data.groupby("type", sort=False, observed=True):
+        x = pd.to_datetime(group["datetime"], utc=True).values.view("i8")
+        y = group["water level"].to_numpy(dtype=np.float64)
+        idx = lttb_downsample((x - x[0]).astype(np.float64), y, n_out)
+        groups.append(group.iloc[idx])
+    return pd.concat(groups)
+
+
+@st.cache(allow_output_mutation=True, hash_funcs={pd.DataFrame: _series_key})
+def build_fig(tide_data: pd.DataFrame) -> "go.Figure":
+    fig = px.line(
+        decimate(tide_data),
+        x="datetime",
+        y="water level",
+        color="type",
+        render_mode="webgl",
+    )
+    fig.update_layout(dragmode="pan")
+    return fig
+
+
+@st.cache
+def harmonic_csv_b64(tide_harmonic: pd.DataFrame) -> str:
+    buf = io.BytesIO()
+    tide_harmonic.to_csv(buf, index=False)
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+def _run_key(
+    show_prediction: bool, start_date: Any, end_date: Any, interval: int
+) -> Tuple[Any, ...]:
+    """Inputs that change what is computed; view-only widgets are left out."""
+    assert uploaded_file is not None
+    return (
+        uploaded_file.id,
+        tide_backend,
+        show_prediction,
+        start_date,
+        end_date,
+        interval,
     )
 
+
+def prediction_inputs(tide_data: pd.DataFrame) -> Tuple[bool, Any, Any, int]:
     start_date: pd.Timestamp = tide_data.datetime.array[0]
     end_date: pd.Timestamp = tide_data.datetime.array[-1]
     interval: int = 3600
@@ -122,30 +360,21 @@ def main_utide(tide_data: pd.DataFrame) -> None:
             end_date = st.date_input("end date", tide_data.datetime.array[-1])
             interval = st.number_input("interval (seconds)", 3600, step=3600)
 
-    if show_prediction and interval >= 3600:
-        datetime_arr = pd.date_range(start_date, end_date, freq=f"{interval}S").array
-        df_predicted = pd.DataFrame(
-            {
-                "datetime": datetime_arr,
-                "water level": utide.reconstruct(mdates.date2num(datetime_arr), coef).h,
-                "type": ["prediction"] * datetime_arr.size,
-            }
-        )
-        tide_data = tide_data.append(df_predicted)
+    return show_prediction, start_date, end_date, interval
+
 
+def render(
+    tide_data: pd.DataFrame, fig: "go.Figure", tide_harmonic: pd.DataFrame
+) -> None:
     ## Visualizing
     if show_data:
         st.write("data source")
-        st.write(tide_data)
+        # streamlit 0.84's DataFrame serializer can't marshal category dtype
+        st.write(tide_data.astype({"type": str}))
 
-    fig = px.line(
-        tide_data, x="datetime", y="water level", color="type", render_mode="webgl"
-    )
-    fig.update_layout(dragmode="pan")
     st.plotly_chart(fig, config=dict({"scrollZoom": True}), use_container_width=True)
 
-    csv: str = tide_harmonic.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
+    b64 = harmonic_csv_b64(tide_harmonic)
     st.markdown(
         f"""
     Harmonic constituent table. 
@@ -156,54 +385,67 @@ def main_utide(tide_data: pd.DataFrame) -> None:
     st.write(tide_harmonic)
 
 
-def main_pytide(tide_data: pd.DataFrame) -> None:
-    tide, tide_harmonic = solve_pytides(tide_data)
+def main_utide(tide_data: pd.DataFrame) -> None:
+    import utide
 
-    start_date: pd.Timestamp = tide_data.datetime.array[0]
-    end_date: pd.Timestamp = tide_data.datetime.array[-1]
-    interval: int = 3600
+    show_prediction, start_date, end_date, interval = prediction_inputs(tide_data)
+    key = _run_key(show_prediction, start_date, end_date, interval)
+    if st.session_state.get("last_key") == key:
+        render(*st.session_state["last_result"])
+        return
 
-    with st.sidebar:
-        st.write("show prediction")
-        show_prediction = st.checkbox("show prediction", True)
-        if show_prediction:
-            start_date = st.date_input("start date", tide_data.datetime.array[0])
-            end_date = st.date_input("end date", tide_data.datetime.array[-1])
-            interval = st.number_input("interval (seconds)", 3600, step=3600)
-    tide_harmonic.sort_values("amplitude", ascending=False).head(10)
+    tide, coef = solve_utide(tide_data)
+    tide_harmonic = pd.DataFrame(
+        {
+            "name": ["mean"] + list(coef["name"]),
+            "amplitude": [coef["mean"]] + list(coef["A"]),
+            "phase": [0] + list(coef["g"]),
+        }
+    )
 
     if show_prediction and interval >= 3600:
-        datetime_arr = pd.date_range(start_date, end_date, freq=f"{interval}S").array
+        datetime_arr = prediction_range(start_date, end_date, interval)
+        time = to_utide_days(datetime_arr.values)
         df_predicted = pd.DataFrame(
             {
                 "datetime": datetime_arr,
-                "water level": tide.at(datetime_arr),
-                "type": ["prediction"] * datetime_arr.size,
+                "water level": utide.reconstruct(time, coef, verbose=False).h,
+                "type": series_type(datetime_arr.size, "prediction"),
             }
         )
-        tide_data = tide_data.append(df_predicted)
+        tide_data = pd.concat([tide_data, df_predicted], ignore_index=True, copy=False)
 
-    ## Visualizing
-    if show_data:
-        st.write("data source")
-        st.write(tide_data)
+    st.session_state["last_key"] = key
+    st.session_state["last_result"] = (tide_data, build_fig(tide_data), tide_harmonic)
+    render(*st.session_state["last_result"])
 
-    fig = px.line(
-        tide_data, x="datetime", y="water level", color="type", render_mode="webgl"
-    )
-    fig.update_layout(dragmode="pan")
-    st.plotly_chart(fig, config=dict({"scrollZoom": True}), use_container_width=True)
 
-    csv: str = tide_harmonic.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
-    st.markdown(
-        f"""
-    Harmonic constituent table. 
-    Download it <a href="data:file/csv;base64,{b64}">here</a>
-    """,
-        unsafe_allow_html=True,
-    )
-    st.write(tide_harmonic)
+def main_pytide(
+    tide_data: pd.DataFrame,
+    solve: Callable[[pd.DataFrame], Tuple["Tide", pd.DataFrame, np.ndarray]],
+) -> None:
+    show_prediction, start_date, end_date, interval = prediction_inputs(tide_data)
+    key = _run_key(show_prediction, start_date, end_date, interval)
+    if st.session_state.get("last_key") == key:
+        render(*st.session_state["last_result"])
+        return
+
+    tide, tide_harmonic, _ = solve(tide_data)
+
+    if show_prediction and interval >= 3600:
+        datetime_arr = prediction_range(start_date, end_date, interval)
+        df_predicted = pd.DataFrame(
+            {
+                "datetime": datetime_arr,
+                "water level": predict_pytides(tide, datetime_arr),
+                "type": series_type(datetime_arr.size, "prediction"),
+            }
+        )
+        tide_data = pd.concat([tide_data, df_predicted], ignore_index=True, copy=False)
+
+    st.session_state["last_key"] = key
+    st.session_state["last_result"] = (tide_data, build_fig(tide_data), tide_harmonic)
+    render(*st.session_state["last_result"])
 
 
 def main() -> None:
@@ -222,7 +464,7 @@ def main() -> None:
     if tide_backend == "utide":
         tide, coef = solve_utide(tide_data)
     else:
-        tide, coef = solve_pytides(tide_data)
+        tide, coef, _ = solve_pytides(tide_data)
 
     start_date: pd.Timestamp = tide_data.datetime.array[0]
     end_date: pd.Timestamp = tide_data.datetime.array[-1]
@@ -235,32 +477,28 @@ def main() -> None:
             start_date = st.date_input("start date", tide_data.datetime.array[0])
             end_date = st.date_input("end date", tide_data.datetime.array[-1])
             interval = st.number_input("interval (seconds)", 3600, step=3600)
-    coef.sort_values("amplitude", ascending=False).head(10)
 
     if show_prediction and interval >= 3600:
-        datetime_arr = pd.date_range(start_date, end_date, freq=f"{interval}S").array
+        datetime_arr = prediction_range(start_date, end_date, interval)
         df_predicted = pd.DataFrame(
             {
                 "datetime": datetime_arr,
-                "water level": tide.at(datetime_arr),
-                "type": ["prediction"] * datetime_arr.size,
+                "water level": predict_pytides(tide, datetime_arr),
+                "type": series_type(datetime_arr.size, "prediction"),
             }
         )
-        tide_data = tide_data.append(df_predicted)
+        tide_data = pd.concat([tide_data, df_predicted], ignore_index=True, copy=False)
 
     ## Visualizing
     if show_data:
         st.write("data source")
-        st.write(tide_data)
+        # streamlit 0.84's DataFrame serializer can't marshal category dtype
+        st.write(tide_data.astype({"type": str}))
 
-    fig = px.line(
-        tide_data, x="datetime", y="water level", color="type", render_mode="webgl"
-    )
-    fig.update_layout(dragmode="pan")
+    fig = build_fig(tide_data)
     st.plotly_chart(fig, config=dict({"scrollZoom": True}), use_container_width=True)
 
-    csv: str = tide_harmonic.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
+    b64 = harmonic_csv_b64(tide_harmonic)
     st.markdown(
         f"""
     Harmonic constituent table. 
@@ -275,6 +513,8 @@ if uploaded_file is not None:
     tide_data = load_file()
     if tide_backend == "utide":
         main_utide(tide_data)
+    elif tide_backend == "fft":
+        main_pytide(tide_data, solve_fft)
     else:
-        main_pytide(tide_data)
+        main_pytide(tide_data, solve_pytides)
     # main()